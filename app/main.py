@@ -1,20 +1,26 @@
 import asyncio
 import contextlib
 import datetime
+import functools
+import hashlib
 import json
 import math
+from collections import OrderedDict
+from enum import Enum
 from io import BytesIO
 from pathlib import Path
 from typing import Optional
 
 import aiohttp
-from bs4 import BeautifulSoup
-from fastapi import FastAPI, Header, HTTPException, status
+import orjson
+from bs4 import BeautifulSoup, SoupStrainer
+from cachetools import TTLCache
+from fastapi import FastAPI, Header, HTTPException, Request, status
 from fastapi.encoders import jsonable_encoder
 from fastapi.responses import JSONResponse
 from PIL import Image, ImageDraw, ImageFile, ImageFont
 from pydantic import BaseModel
-from starlette.responses import StreamingResponse
+from starlette.responses import Response
 
 DATATYPES = {
     "albums": "user.gettopalbums",
@@ -22,10 +28,39 @@ DATATYPES = {
     # "toptracks": "user.gettoptracks",
     "recenttracks": "user.getrecenttracks",
 }
+
+
+class DataType(str, Enum):
+    albums = "albums"
+    artists = "artists"
+    recenttracks = "recenttracks"
+
+
+class Period(str, Enum):
+    week = "7day"
+    month = "1month"
+    three_months = "3month"
+    six_months = "6month"
+    year = "12month"
+    overall = "overall"
+
+
 NO_IMAGE_PLACEHOLDER = (
     "https://lastfm.freetls.fastly.net/i/u/300x300/2a96cbd8b46e442fc41c2b86b821562f.png"
 )
+CHARTLIST_IMAGE_STRAINER = SoupStrainer("td", {"class": "chartlist-image"})
 ImageFile.LOAD_TRUNCATED_IMAGES = True
+# Rendered (chart bytes, ETag) by (username, datatype, period, height, width), and the renders
+# underway.
+RESULT_CACHE = TTLCache(maxsize=64 * 1024 * 1024, ttl=300, getsizeof=lambda entry: len(entry[0]))
+INFLIGHT = {}
+FONT = ImageFont.truetype(
+    f"{Path(__file__).resolve().parent}/fonts/Arial Unicode.ttf", 18, encoding="utf-8"
+)
+
+# Image bytes never change for a given last.fm CDN URL, so keep recently used ones around.
+IMAGE_CACHE_SIZE = 1024
+IMAGE_CACHE = OrderedDict()
 
 from fastapi.middleware.cors import CORSMiddleware
 
@@ -41,75 +76,127 @@ app.add_middleware(
 )
 
 
-@app.post("/lastfm/chart/{username}/{datatype}/{period}")
-async def lastfm_chart(username: str, datatype: str, period: str, height: int = 3, width: int = 3):
+@app.on_event("startup")
+async def startup():
+    app.state.session = aiohttp.ClientSession(
+        connector=aiohttp.TCPConnector(limit=100, ttl_dns_cache=300, keepalive_timeout=75)
+    )
+
+
+@app.on_event("shutdown")
+async def shutdown():
+    await app.state.session.close()
+
+
+@app.api_route("/lastfm/chart/{username}/{datatype}/{period}", methods=["GET", "POST"])
+async def lastfm_chart(
+    request: Request,
+    username: str,
+    datatype: DataType,
+    period: Period,
+    height: int = 3,
+    width: int = 3,
+    if_none_match: Optional[str] = Header(None),
+):
     if height + width > 31:
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
             detail="Height and width cannot be greater than 31",
         )
-    if datatype not in DATATYPES:
-        raise HTTPException(
-            status_code=status.HTTP_400_BAD_REQUEST,
-            detail="Invalid datatype",
-        )
+    key = (username, datatype, period, height, width)
+    entry = RESULT_CACHE.get(key)
+    if entry is None:
+        entry = await singleflight(key, build_chart, username, datatype, period, height, width)
+    chart, etag = entry
+    # Recent tracks change with every scrobble, so have clients revalidate those each time.
+    max_age = 0 if datatype is DataType.recenttracks else 600
+    headers = {"Cache-Control": f"public, max-age={max_age}", "ETag": etag}
+    if etag_matches(if_none_match, etag):
+        if request.method in ("GET", "HEAD"):
+            return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+        return Response(status_code=status.HTTP_412_PRECONDITION_FAILED, headers=headers)
+    return Response(content=chart, media_type="image/webp", status_code=200, headers=headers)
+
+
+def etag_matches(if_none_match, etag):
+    """Whether an If-None-Match header value matches etag, using weak comparison."""
+    if if_none_match is None:
+        return False
+    for tag in if_none_match.split(","):
+        tag = tag.strip()
+        if tag == "*":
+            return True
+        if tag.startswith("W/"):
+            tag = tag[2:]
+        if tag == etag:
+            return True
+    return False
+
+
+async def singleflight(key, func, *args):
+    """Await func(*args), sharing one run of it with concurrent callers for the same key."""
+    task = INFLIGHT.get(key)
+    if task is None:
+        # Run it as its own task so cancelling any one caller doesn't cancel the others.
+        task = asyncio.get_running_loop().create_task(func(*args))
+        INFLIGHT[key] = task
+        task.add_done_callback(lambda _: INFLIGHT.pop(key, None))
+    return await asyncio.shield(task)
+
+
+async def build_chart(username, datatype, period, height, width):
     url = "http://ws.audioscrobbler.com/2.0/"
     params = {
         "user": username,
         "method": DATATYPES[datatype],
-        "period": period,
+        "period": period.value,
         "limit": 100,
     }
     params["api_key"] = "API_KEY"
     params["format"] = "json"
-    async with aiohttp.ClientSession() as session:
-        async with session.get(url, params=params) as response:
-            with contextlib.suppress(aiohttp.ContentTypeError):
-                content = await response.json()
-                if "error" in content or response.status != 200:
-                    raise HTTPException(status_code=response.status, detail=content["message"])
-    chart = await create_chart(content, params["method"], height, width, period, username)
-    return StreamingResponse(content=chart, media_type="image/png", status_code=200)
-
-
-async def create_chart(data, method, height, width, period, username):
+    session = app.state.session
+    async with session.get(url, params=params) as response:
+        with contextlib.suppress(aiohttp.ContentTypeError):
+            content = await response.json(loads=orjson.loads)
+            if "error" in content or response.status != 200:
+                raise HTTPException(status_code=response.status, detail=content["message"])
+    chart = await create_chart(session, content, params["method"], height, width, period, username)
+    chart = chart.getvalue()
+    etag = f'"{hashlib.blake2b(chart, digest_size=8).hexdigest()}"'
+    RESULT_CACHE[(username, datatype, period, height, width)] = (chart, etag)
+    return chart, etag
+
+
+async def create_chart(session, data, method, height, width, period, username):
     chart = []
-    chart_data = {}
     if method == "user.gettopalbums":
-        albums = data["topalbums"]["album"]
-        for album in albums[: width * height]:
+        albums = data["topalbums"]["album"][: width * height]
+        urls = [album["image"][3]["#text"] or NO_IMAGE_PLACEHOLDER for album in albums]
+        chart_data = await get_imgs(session, set(urls))
+        for album, url in zip(albums, urls):
             name = album["name"]
             artist = album["artist"]["name"]
             plays = album["playcount"]
-            if album["image"][3]["#text"] in chart_data:
-                chart_img = chart_data[album["image"][3]["#text"]]
-            else:
-                chart_img = await get_img(album["image"][3]["#text"])
-                chart_data[album["image"][3]["#text"]] = chart_img
             chart.append(
                 (
                     f"{plays} {format_plays(plays)}\n{name} - {artist}",
-                    chart_img,
+                    chart_data[url],
                 )
             )
         img = await charts(chart, width, height)
 
     elif method == "user.gettopartists":
-        artists = data["topartists"]["artist"]
-        scraped_images = await scrape_artists_for_chart(username, period, width * height)
-        iterator = artists[: width * height]
-        for i, artist in enumerate(iterator):
+        artists = data["topartists"]["artist"][: width * height]
+        scraped_images = await scrape_artists_for_chart(session, username, period, width * height)
+        urls = [url or NO_IMAGE_PLACEHOLDER for url in scraped_images[: len(artists)]]
+        chart_data = await get_imgs(session, set(urls))
+        for artist, url in zip(artists, urls):
             name = artist["name"]
             plays = artist["playcount"]
-            if scraped_images[i] in chart_data:
-                chart_img = chart_data[scraped_images[i]]
-            else:
-                chart_img = await get_img(scraped_images[i])
-                chart_data[scraped_images[i]] = chart_img
             chart.append(
                 (
                     f"{plays} {format_plays(plays)}\n{name}",
-                    chart_img,
+                    chart_data[url],
                 )
             )
         img = await charts(chart, width, height)
@@ -118,86 +205,100 @@ async def create_chart(data, method, height, width, period, username):
         tracks = data["recenttracks"]["track"]
         if isinstance(tracks, dict):
             tracks = [tracks]
-        for track in tracks[: width * height]:
+        tracks = tracks[: width * height]
+        urls = [track["image"][3]["#text"] or NO_IMAGE_PLACEHOLDER for track in tracks]
+        chart_data = await get_imgs(session, set(urls))
+        for track, url in zip(tracks, urls):
             name = track["name"]
             artist = track["artist"]["#text"]
-            if track["image"][3]["#text"] in chart_data:
-                chart_img = chart_data[track["image"][3]["#text"]]
-            else:
-                chart_img = await get_img(track["image"][3]["#text"])
-                chart_data[track["image"][3]["#text"]] = chart_img
             chart.append(
                 (
                     f"{name} - {artist}",
-                    chart_img,
+                    chart_data[url],
                 )
             )
-            img = await gen_track_chart(chart, width, height)
+        img = await charts(chart, width, height)
 
     return img
 
 
 async def charts(data, w, h):
-    fnt_file = f"{Path(__file__).resolve().parent}/fonts/Arial Unicode.ttf"
-    fnt = ImageFont.truetype(fnt_file, 18, encoding="utf-8")
-    imgs = []
-    for item in data:
-        img = BytesIO(item[1])
-        image = Image.open(img).convert("RGBA")
-        draw = ImageDraw.Draw(image)
-        texts = item[0].split("\n")
-        if len(texts[1]) > 30:
-            height = 227
-            text = f"{texts[0]}\n{texts[1][:30]}\n{texts[1][30:]}"
-        else:
-            height = 247
-            text = item[0]
-        draw.text(
-            (5, height),
-            text,
-            fill=(255, 255, 255, 255),
-            font=fnt,
-            stroke_width=1,
-            stroke_fill=(255, 255, 255, 0),
-        )
-        _file = BytesIO()
-        image.save(_file, "png")
-        _file.name = f"{item[0]}.png"
-        _file.seek(0)
-        imgs.append(_file)
-    img = create_graph(imgs, w, h)
-    return img
-
-
-async def gen_track_chart(data, w, h):
-    fnt_file = f"{Path(__file__).resolve().parent}/fonts/Arial Unicode.ttf"
-    fnt = ImageFont.truetype(fnt_file, 18, encoding="utf-8")
-    imgs = []
-    for item in data:
-        img = BytesIO(item[1])
-        image = Image.open(img).convert("RGBA")
-        draw = ImageDraw.Draw(image)
-        if len(item[0]) > 30:
-            height = 247
-            text = f"{item[0][:30]}\n{item[0][30:]}"
-        else:
-            height = 267
-            text = item[0]
-        draw.text(
-            (5, height),
-            text,
-            fill=(255, 255, 255, 255),
-            font=fnt,
-            stroke_width=1,
-            stroke_fill=(255, 255, 255, 0),
-        )
-        _file = BytesIO()
-        image.save(_file, "png")
-        _file.name = f"{item[0]}.png"
-        _file.seek(0)
-        imgs.append(_file)
-    img = create_graph(imgs, w, h)
-    return img
+    # Shrink tiles of big grids to fit 2100px, a 6x6k image is blocking when being sent
+    tile_px = 2100 // max(w, h) if w > 7 or h > 7 else 300
+    loop = asyncio.get_running_loop()
+    imgs = await asyncio.gather(
+        *[loop.run_in_executor(None, render_tile, img, caption, tile_px) for caption, img in data]
+    )
+    return await loop.run_in_executor(None, create_graph, imgs, w, h, tile_px)
+
+
+def render_tile(data, caption, tile_px=300):
+    """Decode a tile and draw its caption along the bottom, wrapping each line to fit."""
+    image = open_tile(data)
+    lines = [line for part in caption.split("\n") for line in wrap_at_pixels(part)]
+    height = 287 - 20 * len(lines)
+    strip = caption_strip("\n".join(lines), height)
+    image.paste(strip, (0, height), strip)
+    if tile_px < 300:
+        image.thumbnail((tile_px, tile_px), Image.Resampling.LANCZOS, reducing_gap=3.0)
+    return image
+
+
+def wrap_at_pixels(text, font=FONT, max_px=290, max_lines=2):
+    """Wrap text between words into at most max_lines lines of max_px, ellipsising the rest."""
+    lines = []
+    line = ""
+    for word in text.split(" "):
+        candidate = f"{line} {word}" if line else word
+        if font.getlength(candidate) <= max_px:
+            line = candidate
+            continue
+        if line:
+            lines.append(line)
+        line = word
+        # A single word wider than the tile still has to be broken up.
+        while font.getlength(line) > max_px:
+            cut = len(line) - 1
+            while cut > 1 and font.getlength(line[:cut]) > max_px:
+                cut -= 1
+            lines.append(line[:cut])
+            line = line[cut:]
+    lines.append(line)
+    if len(lines) > max_lines:
+        lines = lines[:max_lines]
+        last = lines[-1]
+        while last and font.getlength(f"{last}…") > max_px:
+            last = last[:-1]
+        lines[-1] = f"{last.rstrip()}…"
+    return lines
+
+
+@functools.lru_cache(maxsize=512)
+def caption_strip(text, top):
+    """Render text onto a transparent strip covering a 300px tile from top down."""
+    strip = Image.new("RGBA", (300, 300 - top), (255, 255, 255, 0))
+    ImageDraw.Draw(strip).text(
+        (5, 0),
+        text,
+        fill=(255, 255, 255, 255),
+        font=FONT,
+    )
+    return strip
+
+
+def open_tile(data):
+    """Decode image bytes to RGB, without copying images that already are."""
+    image = Image.open(BytesIO(data))
+    if image.mode in ("RGBA", "LA", "PA") or "transparency" in image.info:
+        # Flatten onto black, like empty grid cells, so the white captions stay readable.
+        image = image.convert("RGBA")
+        flat = Image.new("RGB", image.size)
+        flat.paste(image, mask=image.getchannel("A"))
+        return flat
+    if image.mode != "RGB":
+        return image.convert("RGB")
+    image.load()
+    return image
 
 
 def chunks(l, n):
@@ -206,32 +307,25 @@ def chunks(l, n):
         yield l[i : i + n]
 
 
-def create_graph(data, w, h):
-    dimensions = (300 * w, 300 * h)
-    final = Image.new("RGBA", dimensions)
+def create_graph(data, w, h, tile_px=300):
+    dimensions = (tile_px * w, tile_px * h)
+    final = Image.new("RGB", dimensions)
     images = chunks(data, w)
     y = 0
     for chunked in images:
         x = 0
-        for img in chunked:
-            new = Image.open(img)
-            w, h = new.size
-            final.paste(new, (x, y, x + w, y + h))
-            x += 300
-        y += 300
-    w, h = final.size
-    if w > 2100 and h > 2100:
-        final = final.resize(
-            (2100, 2100), resample=Image.ANTIALIAS
-        )  # Resize cause a 6x6k image is blocking when being sent
+        for image in chunked:
+            final.paste(image, (x, y))
+            x += tile_px
+        y += tile_px
     file = BytesIO()
-    final.save(file, "webp")
+    final.save(file, "webp", quality=80, method=0)
     file.name = f"chart.webp"
     file.seek(0)
     return file
 
 
-async def scrape_artists_for_chart(username, period, amount):
+async def scrape_artists_for_chart(session, username, period, amount):
     period_format_map = {
         "7day": "LAST_7_DAYS",
         "1month": "LAST_30_DAYS",
@@ -240,50 +334,67 @@ async def scrape_artists_for_chart(username, period, amount):
         "12month": "LAST_365_DAYS",
         "overall": "ALL",
     }
-    tasks = []
     url = f"https://www.last.fm/user/{username}/library/artists"
-    for i in range(1, math.ceil(amount / 50) + 1):
-        params = {"date_preset": period_format_map[period], "page": i}
-        task = asyncio.ensure_future(fetch(url, params, handling="text"))
-        tasks.append(task)
-
-    responses = await asyncio.gather(*tasks)
-
-    images = []
+    date_preset = period_format_map[period]
+
+    # Fetch the first page on its own, most charts fit on it. A short page is also the last one.
+    data = await fetch_text(session, url, {"date_preset": date_preset, "page": 1})
+    images = parse_artist_images(data)
+    if len(images) >= amount or len(images) < 50:
+        return images
+
+    responses = await asyncio.gather(
+        *[
+            fetch_text(session, url, {"date_preset": date_preset, "page": i})
+            for i in range(2, math.ceil(amount / 50) + 1)
+        ]
+    )
     for data in responses:
         if len(images) >= amount:
             break
-        else:
-            soup = BeautifulSoup(data, "html.parser")
-            imagedivs = soup.findAll("td", {"class": "chartlist-image"})
-            images += [
-                div.find("img")["src"].replace("/avatar70s/", "/300x300/") for div in imagedivs
-            ]
+        images += parse_artist_images(data)
 
     return images
 
 
-async def fetch(url, params=None, handling="json"):
-    if params is None:
-        params = {}
-    async with aiohttp.ClientSession() as session:
-        async with session.get(url, params=params) as response:
-            if handling == "json":
-                return await response.json()
-            if handling == "text":
-                return await response.text()
-            return await response
-
-
-async def get_img(url):
-    async with aiohttp.ClientSession() as session:
-        async with session.get(url or NO_IMAGE_PLACEHOLDER) as resp:
-            if resp.status == 200:
-                img = await resp.read()
-                return img
-            async with session.get(NO_IMAGE_PLACEHOLDER) as resp:
-                img = await resp.read()
-                return img
+def parse_artist_images(data):
+    soup = BeautifulSoup(data, "lxml", parse_only=CHARTLIST_IMAGE_STRAINER)
+    imagedivs = soup.find_all("td", {"class": "chartlist-image"})
+    return [div.find("img")["src"].replace("/avatar70s/", "/300x300/") for div in imagedivs]
+
+
+async def fetch_text(session, url, params=None):
+    async with session.get(url, params=params) as response:
+        return await response.text()
+
+
+async def get_img(session, url):
+    url = url or NO_IMAGE_PLACEHOLDER
+    if url in IMAGE_CACHE:
+        IMAGE_CACHE.move_to_end(url)
+        return IMAGE_CACHE[url]
+    async with session.get(url) as resp:
+        img = await resp.read()
+        status_code = resp.status
+    if status_code != 200:
+        if url != NO_IMAGE_PLACEHOLDER:
+            return await get_img(session, NO_IMAGE_PLACEHOLDER)
+        return img
+    IMAGE_CACHE[url] = img
+    if len(IMAGE_CACHE) > IMAGE_CACHE_SIZE:
+        IMAGE_CACHE.popitem(last=False)
+    return img
+
+
+async def get_imgs(session, urls, concurrency=8):
+    """Download each of urls concurrently, returning a {url: bytes} mapping."""
+    sem = asyncio.Semaphore(concurrency)
+
+    async def bounded(url):
+        async with sem:
+            return url, await get_img(session, url)
+
+    return dict(await asyncio.gather(*[bounded(url) for url in urls]))
 
 
 def format_plays(amount):